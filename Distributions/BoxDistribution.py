@@ -1,3 +1,5 @@
+import random
+
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -33,6 +35,10 @@ class BoxDistribution:
         s = forward_min_max_mapping(s, self.min, self.max)
         return s
 
+    def sample_n(self, n: int) -> tf.Tensor:
+        s = self.distribution.sample(n)
+        return forward_min_max_mapping(s, self.min, self.max)
+
     def prob(self, sample: tf.Tensor):
         s = inverse_min_max_mapping(sample, self.min, self.max)
         return tf.clip_by_value(self.distribution.prob(s), 1e-12, 1e12)
@@ -49,16 +55,22 @@ class SmoothedBoxDistribution:
 
         self.factor = factor
 
-        self.helper_dist = tfp.distributions.Categorical(probs=[factor, 1 - factor])
-
     def sample(self) -> tf.Tensor:
-        chosen_dist_id = self.helper_dist.sample()
-        if chosen_dist_id == 0:
+        # choosing between the two mixture components is a single host side coin flip,
+        # sampling it with tf would cost an op dispatch plus a device to host sync.
+        if random.random() < self.factor:
             s = self.uni.sample()
             return forward_min_max_mapping(s, self.box.min, self.box.max)
         else:
             return self.box.sample()
 
+    def sample_n(self, n: int) -> tf.Tensor:
+        box_samples = self.box.sample_n(n)
+        uni_samples = forward_min_max_mapping(self.uni.sample(tf.shape(box_samples)), self.box.min, self.box.max)
+        # one coin flip per sample element, the box distributions used here have a scalar batch shape.
+        choose_uni = tf.random.uniform(tf.shape(box_samples)) < self.factor
+        return tf.where(choose_uni, uni_samples, box_samples)
+
     def prob(self, sample: tf.Tensor):
         box_prob = self.box.prob(sample)
 
@@ -1,7 +1,7 @@
 import random
 import time
 from abc import abstractmethod
-from typing import Tuple, Callable, List, Type
+from typing import Tuple, Callable, List, Type, Optional
 
 import numpy as np
 import tensorflow as tf
@@ -40,6 +40,45 @@ def identity_exploration_function(action_schema: ActionSchema) -> ActionSchema:
     return action_schema
 
 
+def stack_single_element_tensors(tensors: List[tf.Tensor]) -> tf.Tensor:
+    stacked = tf.stack(tensors)
+    assert stacked.shape.num_elements() == len(tensors), "expected exactly one element per tensor"
+    return tf.reshape(stacked, (-1,))
+
+
+def policy_loss_from_targets(on_policy_action_schemas: List[ActionSchema], value_estimates: List[tf.Tensor],
+                             reach_weights: List[tf.Tensor], q_value_targets: List[List[QValueTarget]]) -> tf.Tensor:
+    """
+    The importance weighted policy gradient loss of a batch of v-trace targets.
+    The q value targets of all info_sets are flattened into parallel arrays keyed by the index of their info_set,
+    so the loss terms are computed once for the whole batch and averaged per info_set with a segment mean.
+    This requires every value estimate, importance, q value and log_prob to hold exactly one element,
+    which is asserted on the static shapes.
+    """
+    segment_ids = []
+    on_policy_log_probs = []
+    importances = []
+    q_values = []
+    for i in range(len(q_value_targets)):
+        action_schema = on_policy_action_schemas[i]
+        for action, importance, q_value in q_value_targets[i]:
+            segment_ids.append(i)
+            on_policy_log_probs.append(action_schema.log_prob(action))
+            importances.append(importance)
+            q_values.append(q_value)
+
+    segment_ids = tf.constant(segment_ids, dtype=tf.int32)
+    advantages = stack_single_element_tensors(q_values) - tf.gather(
+        stack_single_element_tensors(value_estimates), segment_ids
+    )
+    local_policy_losses = stack_single_element_tensors(importances) * stack_single_element_tensors(
+        on_policy_log_probs
+    ) * advantages
+    policy_losses = -tf.math.segment_mean(local_policy_losses, segment_ids)
+
+    return tf.reduce_mean(reach_weights * policy_losses)
+
+
 # [state, info_set, value_estimate, action_schema_estimate, off_policy_action_schema,
 #                 on_policy_probability, off_policy_probability, action, direct_reward]
 TrajectoryElement = Tuple[State, InfoSet, tf.Tensor, ActionSchema, ActionSchema, float, float, tf.Tensor, float]
@@ -47,8 +86,10 @@ Trajectory = List[TrajectoryElement or Leaf]
 
 
 def take_action(game: Type[Game], state: State, info_set: InfoSet, on_policy_action_schema: ActionSchema,
-                off_policy_action_schema: ActionSchema):
-    off_policy_probability, action = off_policy_action_schema.sample()
+                off_policy_action_schema: ActionSchema, off_policy_sample: Optional[Tuple[float, tf.Tensor]] = None):
+    if off_policy_sample is None:
+        off_policy_sample = off_policy_action_schema.sample()
+    off_policy_probability, action = off_policy_sample
     on_policy_probability = on_policy_action_schema.prob(action)
     state, info_set, direct_reward = game.act(state, info_set, action)
     return on_policy_probability, off_policy_probability, action, direct_reward, state, info_set
@@ -95,18 +136,23 @@ def gather_unrolls(game: Type[Game], start: TrajectoryElement, num_samples: int,
     for _ in range(num_samples):
         unrolls.append([])
 
+    # all unrolls start from the same off policy action schema, so their first actions are drawn in one batch.
+    first_off_policy_samples = off_policy_action_schema.sample_n(num_samples)
+
+    # indices of the unrolls that have not reached a leaf yet, so finished unrolls are never visited again.
+    active_ids: List[int] = list(range(num_samples))
+
     k = 0
     while True:
         evaluation_worklist: List[Tuple[int, State, InfoSet]] = []
         # sample one action for each rollout path
-        for j in range(num_samples):
-            current_state_info_pair = current_state_info_pairs[j]
-            if current_state_info_pair is None:
-                continue
+        for j in active_ids:
             state, info_set, value_estimate, on_policy_action_schema, off_policy_action_schema = \
                 current_state_info_pairs[j]
+            off_policy_sample = first_off_policy_samples[j] if k == 0 else None
             on_policy_probability, off_policy_probability, action, direct_reward, new_state, new_info_set = \
-                take_action(game, state, info_set, on_policy_action_schema, off_policy_action_schema)
+                take_action(game, state, info_set, on_policy_action_schema, off_policy_action_schema,
+                            off_policy_sample)
             unrolls[j].append(
                 (
                     state, info_set, value_estimate, on_policy_action_schema, off_policy_action_schema,
@@ -121,8 +167,9 @@ def gather_unrolls(game: Type[Game], start: TrajectoryElement, num_samples: int,
                 evaluation_worklist.append((j, new_state, new_info_set))
 
         k += 1
-        if k == max_steps:
+        if k == max_steps or len(evaluation_worklist) == 0:
             break
+        active_ids = [j for j, _, _ in evaluation_worklist]
 
         # group worklist into batches and compute estimates
         worklist_pointer = 0
@@ -143,10 +190,12 @@ def gather_unrolls(game: Type[Game], start: TrajectoryElement, num_samples: int,
     return unrolls
 
 
-def trajectory_to_vtrace_targets(trajectory: Trajectory, discount: float, p: float, c: float):
-    # first compute v_s for each state
-    value_targets: List[tf.Tensor] = [tf.zeros(shape=())] * (len(trajectory) - 1)
-    q_value_targets = [tf.zeros(shape=())] * (len(trajectory) - 1)
+def trajectory_to_root_vtrace_target(trajectory: Trajectory, discount: float, p: float, c: float):
+    """
+    :returns The v-trace value target and q value target of the first element of the trajectory.
+    Computed in a single bottom up sweep which only keeps the v_s of the next state.
+    """
+    assert len(trajectory) > 1, "the trajectory needs a bootstrap element or a Leaf after its first element"
 
     te = trajectory[-1]
     if isinstance(te, Leaf):
@@ -166,15 +215,14 @@ def trajectory_to_vtrace_targets(trajectory: Trajectory, discount: float, p: flo
         td = p_t * (direct_reward + discount * value_estimate_nn - value_estimate_cn)
         v_s = value_estimate_cn + td + discount * c_t * (v_s_nn - value_estimate_nn)
 
-        value_targets[i] = v_s
-
-        q_s = direct_reward + discount * v_s_nn
-        q_value_targets[i] = q_s
-
+        v_s_next = v_s_nn
         v_s_nn = v_s
         value_estimate_nn = value_estimate_cn
 
-    return zip(value_targets, q_value_targets)
+    # after the sweep direct_reward and v_s_next belong to the first element.
+    q_s = direct_reward + discount * v_s_next
+
+    return v_s, q_s
 
 
 def valid_q_target(importance: tf.Tensor, q_value: tf.Tensor):
@@ -230,14 +278,15 @@ def analyse(game: Type[Game], trajectory: Trajectory,
             unrolls.append(unroll_from_outer_trajectory)
 
         v_trace_targets = [
-            list(trajectory_to_vtrace_targets(unroll, discount, p, c))[0] for unroll in unrolls
+            trajectory_to_root_vtrace_target(unroll, discount, p, c) for unroll in unrolls
         ]
 
-        mean_value_target = tf.zeros(shape=())
+        value_targets, _ = zip(*v_trace_targets[:num_samples])
+        mean_value_target = tf.reduce_mean(tf.stack(value_targets), axis=0)
+
         q_value_targets = []
         for j in range(num_samples):
-            value_target, q_value_target = v_trace_targets[j]
-            mean_value_target += value_target
+            _, q_value_target = v_trace_targets[j]
             _, _, _, _, _, on_policy_probability, off_policy_probability, action, _ = unrolls[j][0]
             imp = tf.minimum(p, on_policy_probability / off_policy_probability)
             if valid_q_target(imp, q_value_target[info_set.current_player]):
@@ -248,7 +297,6 @@ def analyse(game: Type[Game], trajectory: Trajectory,
                         q_value_target[info_set.current_player],
                     )
                 )
-        mean_value_target /= num_samples
 
         if valid_v_trace_target(reach_importance_weight, mean_value_target, q_value_targets):
             trajectory_v_trace_targets.append(
@@ -259,21 +307,11 @@ def analyse(game: Type[Game], trajectory: Trajectory,
 
 
 def compute_gradient_mean(grads: List[VTraceGradients]) -> VTraceGradients:
-    result = [None, None]
-    for grad_pair in grads:
-        for i in range(2):
-            if result[i] is None:
-                result[i] = grad_pair[i]
-            else:
-                result[i] = [
-                    result[i][z] + grad_pair[i][z] for z in range(len(result[i]))
-                ]
-
-    for i in range(2):
-        for j in range(len(result[i])):
-            result[i][j] /= len(grads)
-
-    v_grads, p_grads = result
+    # sum each variable's gradients over all pairs with a single add_n instead of a chain of pairwise adds.
+    v_grads, p_grads = [
+        [tf.add_n(list(variable_grads)) / len(grads) for variable_grads in zip(*[grad_pair[i] for grad_pair in grads])]
+        for i in range(2)
+    ]
     return v_grads, p_grads
 
 
@@ -295,7 +333,8 @@ def flatten_gradients(gradients: VTraceGradients):
     for i in range(2):
         grads = gradients[i]
         for g in grads:
-            shapes[i].append(tf.shape(g))
+            # the static shape is known on the host, so no shape op is issued per gradient tensor.
+            shapes[i].append(g.shape)
             grad_values.append(
                 tf.reshape(g, shape=(-1,))
             )
@@ -313,7 +352,7 @@ def reshape_gradient_values(gradient_values: tf.Tensor, shapes: Tuple[List[tf.Te
         l_shapes = shapes[i]
         for j in range(len(l_shapes)):
             shape = l_shapes[j]
-            element_count = tf.reduce_prod(shape)
+            element_count = shape.num_elements()
             grads.append(
                 tf.reshape(
                     gradient_values[pointer:pointer + element_count],
@@ -395,7 +434,7 @@ def filter_invalid_gradients(gradients: VTraceGradients) -> VTraceGradients:
         grads = gradients[i]
         for j in range(len(grads)):
             g = grads[j]
-            if tf.reduce_any(tf.math.is_nan(g)) or tf.reduce_any(tf.math.is_inf(g)):
+            if not tf.reduce_all(tf.math.is_finite(g)):
                 contains_nan = True
                 grads[j] = tf.zeros_like(grads[j])
         if contains_nan:
@@ -7,17 +7,21 @@ from typing import Tuple, List
 import jsonpickle
 import tensorflow as tf
 import tensorflow_probability as tfp
+import numpy as np
 
 import matplotlib.pyplot as plt
 
 from Distributions.CategoricalDistribution import categorical_smoothing_function
-from EvaluationTool import Estimator, VTraceTarget, VTraceGradients
+from EvaluationTool import Estimator, VTraceTarget, VTraceGradients, policy_loss_from_targets
 from MDP import Game, State, InfoSet, Leaf, ActionSchema
 
 size = 20
 goal_x = 5
 goal_y = 5
 
+# the logits of the uniform action schema never change, so the tensor is created once.
+uniform_logits = tf.zeros(shape=(4,))
+
 
 class GridWorldState(State):
     def __init__(self, x, y):
@@ -34,6 +38,11 @@ class GridWorldActionSchema(ActionSchema):
         p = self.dist.prob(s)
         return p, s
 
+    def sample_n(self, n: int) -> List[Tuple[float, tf.Tensor]]:
+        s = self.dist.sample(n)
+        p = self.dist.prob(s)
+        return list(zip(tf.unstack(p), tf.unstack(s)))
+
     def prob(self, action: tf.Tensor) -> tf.Tensor:
         p = self.dist.prob(action)
         return p
@@ -51,7 +60,7 @@ class GridWorldInfoSet(InfoSet):
         self.position_y = state.position_y
 
     def get_action_schema(self) -> ActionSchema:
-        return GridWorldActionSchema(tfp.distributions.Categorical(logits=tf.zeros(shape=(4,))))
+        return GridWorldActionSchema(tfp.distributions.Categorical(logits=uniform_logits))
 
 
 class GridWorld(Game):
@@ -93,7 +102,7 @@ class GridWorld(Game):
 
     @staticmethod
     def show_tile_values(estimator: Estimator):
-        board = tf.zeros(shape=(size, size)).numpy()
+        board = np.zeros(shape=(size, size), dtype=np.float32)
         for i in range(size):
             for j in range(size):
                 info_set = GridWorldInfoSet(GridWorldState(i, j))
@@ -171,12 +180,12 @@ class GridWorldEstimator(Estimator):
         return GridWorldActionSchema(c_dist)
 
     def evaluate(self, info_sets: List[InfoSet]) -> List[Tuple[tf.Tensor, ActionSchema]]:
-        batch = [self.info_set_to_vector(info_set) for info_set in info_sets]
-        output_policy = self.internal_network_policy(tf.stack(batch))
+        batch = tf.stack([self.info_set_to_vector(info_set) for info_set in info_sets])
+        output_policy = self.internal_network_policy(batch)
         action_schemas: List[ActionSchema] = [
             self.vector_to_action_schema(vector) for vector in tf.unstack(output_policy)
         ]
-        output_value = self.internal_network_value(tf.stack(batch))
+        output_value = self.internal_network_value(batch)
         values = tf.unstack(output_value, axis=0)
         return list(zip(values, action_schemas))
 
@@ -190,20 +199,9 @@ class GridWorldEstimator(Estimator):
             )
             value_loss = tf.reduce_mean(value_losses)
 
-            policy_losses = []
-            for i in range(len(targets)):
-                local_policy_losses = []
-                action_schema = on_policy_action_schemas[i]
-                assert isinstance(action_schema, GridWorldActionSchema)
-                value_estimate = value_estimates[i]
-                for action, importance, q_value in q_value_targets[i]:
-                    advantage = q_value - value_estimate
-                    on_policy_log_prob = action_schema.log_prob(action)
-                    policy_loss = importance * on_policy_log_prob * advantage
-                    local_policy_losses.append(policy_loss)
-                policy_losses.append(-tf.reduce_mean(tf.stack(local_policy_losses)))
-
-            policy_loss = tf.reduce_mean(reach_weights * tf.stack(policy_losses))
+            assert all(isinstance(action_schema, GridWorldActionSchema) for action_schema in on_policy_action_schemas)
+            policy_loss = policy_loss_from_targets(on_policy_action_schemas, value_estimates, reach_weights,
+                                                   q_value_targets)
 
             for weights in self.internal_network_value.get_weights():
                 value_loss += self.weight_decay * tf.nn.l2_loss(weights)
@@ -14,7 +14,7 @@ import matplotlib.pyplot as plt
 
 from Distributions.BoxDistribution import BoxDistribution, box_smoothing_function
 from EvaluationTool import Estimator, VTraceTarget, VTraceGradients, take_action, create_trajectory, \
-    identity_exploration_function
+    identity_exploration_function, policy_loss_from_targets
 from Helpers.hessianFreeOptimizer import get_natural_gradient, \
     get_natural_gradient_hessian_free_back_over_back, get_natural_gradient_hessian_free_forward_over_back
 from Helpers.lbfgsOptimizer import get_lbfg_gradient
@@ -46,6 +46,18 @@ class GridWorldContinuousActionSchema(ActionSchema):
 
         return p_x * p_y, tf.concat([s_x, s_y], axis=0)
 
+    def sample_n(self, n: int) -> List[Tuple[float, tf.Tensor]]:
+        s_x = self.dist_x.sample_n(n)
+        p_x = self.dist_x.prob(s_x)
+
+        s_y = self.dist_y.sample_n(n)
+        p_y = self.dist_y.prob(s_y)
+
+        return [
+            (p, tf.concat([x, y], axis=0))
+            for p, x, y in zip(tf.unstack(p_x * p_y), tf.unstack(s_x), tf.unstack(s_y))
+        ]
+
     def prob(self, action: tf.Tensor) -> float:
         p_x = self.dist_x.prob(action[0])
         p_y = self.dist_y.prob(action[1])
@@ -81,13 +93,11 @@ class GridWorldContinuous(Game):
 
         new_state = copy.deepcopy(state)
 
-        new_state.position_x += tf.clip_by_value(action[0], -1, 1)
-        new_state.position_y += tf.clip_by_value(action[1], -1, 1)
-
-        new_state.position_x = tf.cast(min(max(0.0, new_state.position_x), size), dtype=tf.float32)
-        new_state.position_y = tf.cast(min(max(0.0, new_state.position_y), size), dtype=tf.float32)
+        # the position is host side scalar state, so it is updated with numpy instead of tf ops.
+        new_state.position_x = np.float32(np.clip(new_state.position_x + np.clip(action[0], -1, 1), 0.0, size))
+        new_state.position_y = np.float32(np.clip(new_state.position_y + np.clip(action[1], -1, 1), 0.0, size))
 
-        if tf.abs(new_state.position_x - goal_x) <= size * 0.1 and tf.abs(new_state.position_y - goal_y) <= size * 0.1:
+        if abs(new_state.position_x - goal_x) <= size * 0.1 and abs(new_state.position_y - goal_y) <= size * 0.1:
             dr = tf.ones(shape=(1,))
             return Leaf(), Leaf(), dr
         else:
@@ -103,7 +113,7 @@ class GridWorldContinuous(Game):
 
     @staticmethod
     def show_tile_values(estimator: Estimator):
-        board = tf.zeros(shape=(size, size)).numpy()
+        board = np.zeros(shape=(size, size), dtype=np.float32)
         for i in range(size):
             for j in range(size):
                 info_set = GridWorldContinuousInfoSet(GridWorldState(i, j))
@@ -232,10 +242,10 @@ class GridWorldContinuousEstimator(Estimator):
         return action_schemas
 
     def evaluate(self, info_sets: List[InfoSet]) -> List[Tuple[tf.Tensor, ActionSchema]]:
-        batch = [self.info_set_to_vector(info_set) for info_set in info_sets]
-        output_policy = self.internal_network_policy(tf.stack(batch))
+        batch = tf.stack([self.info_set_to_vector(info_set) for info_set in info_sets])
+        output_policy = self.internal_network_policy(batch)
         action_schemas = self.policy_network_to_action_schemas(output_policy)
-        output_value = self.internal_network_value(tf.stack(batch))
+        output_value = self.internal_network_value(batch)
         values = tf.unstack(output_value, axis=0)
         return list(zip(values, action_schemas))
 
@@ -245,20 +255,11 @@ class GridWorldContinuousEstimator(Estimator):
         targets, value_estimates, weight_decay = targets_and_value_estimates_and_weight_decay
         info_sets, reach_weights, value_targets, q_value_targets = zip(*targets)
 
-        policy_losses = []
-        for i in range(len(targets)):
-            local_policy_losses = []
-            action_schema = on_policy_action_schemas[i]
-            assert isinstance(action_schema, GridWorldContinuousActionSchema)
-            value_estimate = value_estimates[i]
-            for action, importance, q_value in q_value_targets[i]:
-                advantage = q_value - value_estimate
-                on_policy_log_prob = action_schema.log_prob(action)
-                policy_loss = importance * on_policy_log_prob * advantage
-                local_policy_losses.append(policy_loss)
-            policy_losses.append(-tf.reduce_mean(tf.stack(local_policy_losses)))
-
-        policy_loss = tf.reduce_mean(reach_weights * tf.stack(policy_losses))
+        assert all(
+            isinstance(action_schema, GridWorldContinuousActionSchema) for action_schema in on_policy_action_schemas
+        )
+        policy_loss = policy_loss_from_targets(on_policy_action_schemas, value_estimates, reach_weights,
+                                               q_value_targets)
 
         return policy_loss
 
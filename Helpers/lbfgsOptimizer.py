@@ -1,5 +1,4 @@
 import tensorflow as tf
-import numpy as np
 import tensorflow_probability as tfp
 
 """
@@ -24,23 +23,23 @@ def function_factory(model, loss, train_x, train_y):
             loss_value, gradients = f(model_parameters).
     """
 
-    # obtain the shapes of all trainable parameters in the model
-    shapes = tf.shape_n(model.trainable_variables)
+    # obtain the static shapes of all trainable parameters in the model. they are known on the host,
+    # so no shape ops are needed to compute the sizes below.
+    shapes = [variable.shape for variable in model.trainable_variables]
     n_tensors = len(shapes)
 
-    # we'll use tf.dynamic_stitch and tf.dynamic_partition later, so we need to
-    # prepare required information first
-    count = 0
-    idx = []  # stitch indices
-    part = []  # partition indices
+    # every trainable variable occupies one contiguous slab of the 1D parameter vector, so flattening is a plain
+    # concat and restoring the shapes is a plain split. No stitch or partition indices are required.
+    sizes = [shape.num_elements() for shape in shapes]
 
-    for i, shape in enumerate(shapes):
-        n = np.product(shape)
-        idx.append(tf.reshape(tf.range(count, count + n, dtype=tf.int32), shape))
-        part.extend([i] * n)
-        count += n
+    def flatten(tensors):
+        """Concatenates a list of tensors shaped like the model's trainable variables into one 1D tf.Tensor."""
+        return tf.concat([tf.reshape(t, [-1]) for t in tensors], axis=0)
 
-    part = tf.constant(part)
+    def unflatten(params_1d):
+        """Splits a 1D tf.Tensor back into a list of tensors shaped like the model's trainable variables."""
+        params = tf.split(params_1d, sizes)
+        return [tf.reshape(param, shape) for shape, param in zip(shapes, params)]
 
     @tf.function()
     def assign_new_model_parameters(params_1d):
@@ -49,9 +48,8 @@ def function_factory(model, loss, train_x, train_y):
             params_1d [in]: a 1D tf.Tensor representing the model's trainable parameters.
         """
 
-        params = tf.dynamic_partition(params_1d, part, n_tensors)
-        for i, (shape, param) in enumerate(zip(shapes, params)):
-            model.trainable_variables[i].assign(tf.reshape(param, shape))
+        for i, param in enumerate(unflatten(params_1d)):
+            model.trainable_variables[i].assign(param)
 
     # now create a function that will be returned by this factory
     def f(params_1d):
@@ -70,46 +68,51 @@ def function_factory(model, loss, train_x, train_y):
             # calculate the loss
             loss_value = loss(model, train_x, train_y)
 
-        # calculate gradients and convert to 1D tf.Tensor
-        grads = tape.gradient(loss_value, model.trainable_variables)
-        grads = tf.dynamic_stitch(idx, grads)
+        # calculate gradients and convert to 1D tf.Tensor. variables the loss does not depend on get zero
+        # gradients, so the flattened gradient always matches the parameter vector.
+        grads = tape.gradient(loss_value, model.trainable_variables,
+                              unconnected_gradients=tf.UnconnectedGradients.ZERO)
+        grads = flatten(grads)
 
         return loss_value, grads
 
     # store these information as members so we can use them outside the scope
-    f.idx = idx
-    f.part = part
+    f.flatten = flatten
+    f.unflatten = unflatten
     f.n_tensors = n_tensors
     f.shapes = shapes
+    f.sizes = sizes
 
     return f
 
-def get_lbfg_gradient(model, loss_fun, train_x, train_y, param_cover_factor):
+def get_lbfg_gradient(model, loss_fun, train_x, train_y, param_cover_factor, max_iterations: int = 50):
     func = function_factory(model, loss_fun, train_x, train_y)
 
     # convert initial model parameters to a 1D tf.Tensor
-    init_params = tf.dynamic_stitch(func.idx, model.trainable_variables)
+    init_params = func.flatten(model.trainable_variables)
+
+    # covering the parameters is only affordable for small models, the cap bounds the cost of one call.
+    iterations = min(int(init_params.shape[0] * param_cover_factor), max_iterations)
 
     # train the model with L-BFGS solver
     results = tfp.optimizer.lbfgs_minimize(
         value_and_gradients_function=func,
         initial_position=init_params,
-        max_iterations=int(init_params.shape[0] * param_cover_factor),
-        max_line_search_iterations=int(init_params.shape[0] * param_cover_factor)
+        max_iterations=iterations,
+        max_line_search_iterations=iterations
     )
 
     # after training, the final optimized parameters are still in results.position
     # so we have to manually put them back to the model
     gradient_estimate = init_params - results.position
 
-    params = tf.dynamic_partition(gradient_estimate, func.part, func.n_tensors)
-    grads = []
-    for i, (shape, param) in enumerate(zip(func.shapes, params)):
-        grads.append(tf.reshape(param, shape))
+    # clip the gradient to the global norm of the parameters the model holds after the line search, i.e. the ones
+    # last assigned by f. the gradient is still flat, so its norm is a single reduction and the clip is applied
+    # before unflattening. the parameters are reduced per variable without concatenating them first.
+    gradient_norm = tf.norm(gradient_estimate)
+    parameter_norm = tf.linalg.global_norm(model.trainable_variables)
+    gradient_estimate *= tf.where(gradient_norm > parameter_norm, parameter_norm / gradient_norm, 1.0)
 
-    grads, _ = tf.clip_by_global_norm(
-        grads,
-        tf.linalg.global_norm(model.trainable_variables)
-    )
+    grads = func.unflatten(gradient_estimate)
 
     return grads
@@ -1,5 +1,5 @@
 from abc import abstractmethod
-from typing import Tuple
+from typing import Tuple, List
 
 import tensorflow as tf
 
@@ -21,6 +21,14 @@ class ActionSchema:
     def sample(self) -> Tuple[float, tf.Tensor]:
         pass
 
+    """
+    :returns n independent samples of (probability, action_description).
+    Override this if the schema can draw all n samples with a single op.
+    """
+
+    def sample_n(self, n: int) -> List[Tuple[float, tf.Tensor]]:
+        return [self.sample() for _ in range(n)]
+
     @abstractmethod
     def prob(self, action: tf.Tensor) -> tf.Tensor:
         pass